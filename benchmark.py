@@ -0,0 +1,132 @@
+"""Compares the OrderBook side-book backends (see books.py) under different order flows.
+
+Run from root directory: python benchmark.py [number of operations]
+Each flow is run once through an OrderBook, recording every call it makes on its bids and asks books.
+Each backend is then timed replaying only those calls, so the rest of the matching engine
+(logging, subscribers lookup, depth tracking, expiry) doesn't drown out the backends' differences.
+
+Measured at 20000 operations (two runs, seconds spent in the books, avl / heap / sorted):
+- passive:      0.35 / 0.057-0.059 / 0.071-0.085  -> 'heap' wins, ~6x faster than 'avl'
+- aggressive:   0.35-0.36 / 0.070-0.095 / 0.060  -> 'sorted' wins, ~6x faster than 'avl'
+- cancel_heavy: 0.069-0.082 / 0.031-0.037 / 0.017-0.021  -> 'sorted' wins, ~4x faster than 'avl'
+"""
+from main import OrderBook, Order
+from books import BACKENDS, SortedBook
+import logging
+import os
+import random
+import sys
+import time
+
+SENDERS = [f'sender{i}' for i in range(8)]
+
+
+def passive_flow(n, rng):
+    """Resting orders far from the touch, almost never crossing. Book grows to ~n orders."""
+    for _ in range(n):
+        if rng.random() < 0.5:
+            yield 'add', Order(Order.BID, rng.randint(1, 1000), rng.randint(1, 100))
+        else:
+            yield 'add', Order(Order.ASK, rng.randint(1001, 2000), rng.randint(1, 100))
+
+
+def aggressive_flow(n, rng):
+    """Overlapping prices, most orders trade against the top of the book."""
+    for _ in range(n):
+        side = Order.BID if rng.random() < 0.5 else Order.ASK
+        yield 'add', Order(side, rng.randint(990, 1010), rng.randint(1, 100))
+
+
+def cancel_heavy_flow(n, rng):
+    """Market-maker like flow: resting orders, most of them cancelled shortly after."""
+    resting = []
+    for _ in range(n):
+        if resting and rng.random() < 0.6:
+            yield 'remove', resting.pop(rng.randrange(len(resting)))
+        else:
+            if rng.random() < 0.5:
+                order = Order(Order.BID, rng.randint(900, 999), rng.randint(1, 100))
+            else:
+                order = Order(Order.ASK, rng.randint(1001, 1100), rng.randint(1, 100))
+            resting.append(order)
+            yield 'add', order
+
+
+FLOWS = {
+    'passive':      passive_flow,
+    'aggressive':   aggressive_flow,
+    'cancel_heavy': cancel_heavy_flow,
+    }
+
+
+def record_book_calls(flow, n, seed=0):
+    """Runs n operations of flow against a fresh OrderBook.
+    Returns the list of (best, method name, args) calls it made on its books, best being 'max' (bids) or 'min' (asks)."""
+    calls = []
+    
+    class RecordingBook(SortedBook):
+        def insert(self, key, order):
+            calls.append((self.best, 'insert', (key, order)))
+            super().insert(key, order)
+        
+        def get(self, key, default=None):
+            calls.append((self.best, 'get', (key, default)))
+            return super().get(key, default)
+        
+        def remove(self, key):
+            calls.append((self.best, 'remove', (key,)))
+            super().remove(key)
+        
+        def best_item(self):
+            calls.append((self.best, 'best_item', ()))
+            return super().best_item()
+        
+        def pop_best(self):
+            calls.append((self.best, 'pop_best', ()))
+            return super().pop_best()
+        
+        def is_empty(self):
+            calls.append((self.best, 'is_empty', ()))
+            return super().is_empty()
+    
+    rng = random.Random(seed)
+    order_book = OrderBook(os.devnull, backend=RecordingBook)
+    for i, (op, order) in enumerate(FLOWS[flow](n, rng)):
+        if op == 'add':
+            order_book.add_order(order, SENDERS[i % len(SENDERS)])
+        else:
+            try:
+                order_book.remove_order(order.id, order.sender_id)
+            except KeyError:
+                # Order was already filled
+                pass
+    return calls
+
+
+def replay(backend, calls, repeat=3):
+    """Returns the best of `repeat` timings (seconds) of replaying calls against fresh books of backend."""
+    timings = []
+    for _ in range(repeat):
+        books = {'max': BACKENDS[backend](best='max'), 'min': BACKENDS[backend](best='min')}
+        bound_calls = [(getattr(books[best], name), args) for best, name, args in calls]
+        start = time.perf_counter()
+        for method, args in bound_calls:
+            method(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    logging.disable(logging.CRITICAL)
+    print(f'{n} operations per flow (seconds spent in the books, lower is better)')
+    print(f'{"flow":<14}{"calls":>8}' + ''.join(f'{backend:>10}' for backend in BACKENDS))
+    for flow in FLOWS:
+        calls = record_book_calls(flow, n)
+        timings = {backend: replay(backend, calls) for backend in BACKENDS}
+        winner = min(timings, key=timings.get)
+        print(f'{flow:<14}{len(calls):>8}' + ''.join(f'{timings[backend]:>10.4f}' for backend in BACKENDS) + f'   <- {winner}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+from abc import ABC, abstractmethod
+import bisect
+import heapq
+
+
+class Book(ABC):
+    """A single side of the orderbook (bids or asks), mapping Order._key() to Order.
+    The "best" order is the one with the highest key if best='max' (bids), or the lowest if best='min' (asks).
+    Inserting an existing key replaces its order.
+    Subclasses must implement insert, get, remove, best_item, pop_best, items and count.
+    """
+    
+    def __init__(self, best):
+        if best != 'max' and best != 'min':
+            raise ValueError(f'Tried to initialize Book with illegal best arg: "{best}". Only "max" or "min" allowed.')
+        self.best = best
+    
+    @abstractmethod
+    def insert(self, key, order):
+        """Inserts order under key, replacing the order already indexed by key, if any."""
+    
+    @abstractmethod
+    def get(self, key, default=None):
+        """Returns the order indexed by key, or default if no such key exists."""
+    
+    @abstractmethod
+    def remove(self, key):
+        """Removes key from the book. Raises KeyError if no such key exists."""
+    
+    @abstractmethod
+    def best_item(self):
+        """Returns the (key, order) pair of the best order. Raises ValueError if the book is empty."""
+    
+    @abstractmethod
+    def pop_best(self):
+        """Removes and returns the (key, order) pair of the best order. Raises ValueError if the book is empty."""
+    
+    @abstractmethod
+    def items(self):
+        """Iterates over (key, order) pairs in ascending key order."""
+    
+    @property
+    @abstractmethod
+    def count(self):
+        """The number of orders in the book."""
+    
+    def values(self):
+        """Iterates over orders in ascending key order."""
+        return (order for _, order in self.items())
+    
+    def keys(self):
+        return (key for key, _ in self.items())
+    
+    def is_empty(self):
+        return self.count == 0
+    
+    def min_item(self):
+        if self.best == 'min':
+            return self.best_item()
+        return self._first_item()
+    
+    def max_item(self):
+        if self.best == 'max':
+            return self.best_item()
+        return self._last_item()
+    
+    def _first_item(self):
+        for item in self.items():
+            return item
+        raise ValueError('Book is empty')
+    
+    def _last_item(self):
+        item = None
+        for item in self.items():
+            pass
+        if item is None:
+            raise ValueError('Book is empty')
+        return item
+    
+    def __len__(self):
+        return self.count
+    
+    def __contains__(self, key):
+        return self.get(key) is not None
+    
+    def __iter__(self):
+        return self.keys()
+
+
+class AVLBook(Book):
+    """Backed by bintrees.AVLTree. All operations are O(log(n)).
+    bintrees is imported only when an AVLBook is created."""
+    
+    def __init__(self, best):
+        from bintrees import AVLTree
+        super().__init__(best)
+        self.tree = AVLTree()
+    
+    def insert(self, key, order):
+        self.tree.insert(key, order)
+    
+    def get(self, key, default=None):
+        return self.tree.get(key, default)
+    
+    def remove(self, key):
+        self.tree.remove(key)
+    
+    def best_item(self):
+        return self.tree.max_item() if self.best == 'max' else self.tree.min_item()
+    
+    def pop_best(self):
+        return self.tree.pop_max() if self.best == 'max' else self.tree.pop_min()
+    
+    def items(self):
+        return self.tree.items()
+    
+    def values(self):
+        return self.tree.values()
+    
+    def _first_item(self):
+        return self.tree.min_item()
+    
+    def _last_item(self):
+        return self.tree.max_item()
+    
+    @property
+    def count(self):
+        return self.tree.count
+
+
+class HeapBook(Book):
+    """Backed by a heapq heap of keys and a key -> order dict.
+    insert and pop_best are O(log(n)), get, remove and best_item are O(1) amortized:
+    removed keys are only dropped from the dict, and discarded from the heap once they reach its top (lazy deletion).
+    Ordered iteration sorts the book, O(n*log(n)).
+    """
+    
+    def __init__(self, best):
+        super().__init__(best)
+        self.orders = {}
+        self.heap = []  # (heap_key, key) pairs. heap_key is the negated key for best='max'
+    
+    def _heap_key(self, key):
+        return tuple(-x for x in key) if self.best == 'max' else key
+    
+    def insert(self, key, order):
+        if key not in self.orders:
+            heapq.heappush(self.heap, (self._heap_key(key), key))
+        self.orders[key] = order
+    
+    def get(self, key, default=None):
+        return self.orders.get(key, default)
+    
+    def remove(self, key):
+        del self.orders[key]
+        if len(self.heap) > 2 * len(self.orders) + 64:
+            # Too many stale keys, rebuild the heap from the live ones
+            self.heap = [(self._heap_key(k), k) for k in self.orders]
+            heapq.heapify(self.heap)
+    
+    def _discard_stale(self):
+        heap = self.heap
+        while heap and heap[0][1] not in self.orders:
+            heapq.heappop(heap)
+        if not heap:
+            raise ValueError('Book is empty')
+    
+    def best_item(self):
+        self._discard_stale()
+        key = self.heap[0][1]
+        return key, self.orders[key]
+    
+    def pop_best(self):
+        self._discard_stale()
+        _, key = heapq.heappop(self.heap)
+        return key, self.orders.pop(key)
+    
+    def items(self):
+        return iter(sorted(self.orders.items(), key=lambda item: item[0]))
+    
+    @property
+    def count(self):
+        return len(self.orders)
+
+
+class SortedBook(Book):
+    """Backed by a bisect-maintained sorted list of keys and a key -> order dict.
+    get, best_item and ordered iteration are cheap; insert and remove are O(log(n)) search + O(n) memmove,
+    which is fast for the books sizes we usually see. pop_best is O(1) for best='max'.
+    """
+    
+    def __init__(self, best):
+        super().__init__(best)
+        self.orders = {}
+        self.sorted_keys = []
+    
+    def insert(self, key, order):
+        if key not in self.orders:
+            bisect.insort(self.sorted_keys, key)
+        self.orders[key] = order
+    
+    def get(self, key, default=None):
+        return self.orders.get(key, default)
+    
+    def remove(self, key):
+        del self.orders[key]
+        del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+    
+    def _best_index(self):
+        if not self.sorted_keys:
+            raise ValueError('Book is empty')
+        return -1 if self.best == 'max' else 0
+    
+    def best_item(self):
+        key = self.sorted_keys[self._best_index()]
+        return key, self.orders[key]
+    
+    def pop_best(self):
+        key = self.sorted_keys.pop(self._best_index())
+        return key, self.orders.pop(key)
+    
+    def items(self):
+        return ((key, self.orders[key]) for key in self.sorted_keys)
+    
+    def _first_item(self):
+        if not self.sorted_keys:
+            raise ValueError('Book is empty')
+        key = self.sorted_keys[0]
+        return key, self.orders[key]
+    
+    def _last_item(self):
+        if not self.sorted_keys:
+            raise ValueError('Book is empty')
+        key = self.sorted_keys[-1]
+        return key, self.orders[key]
+    
+    @property
+    def count(self):
+        return len(self.orders)
+
+
+BACKENDS = {
+    'avl':    AVLBook,
+    'heap':   HeapBook,
+    'sorted': SortedBook,
+    }
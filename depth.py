@@ -0,0 +1,175 @@
+import random
+
+
+class _Level:
+    __slots__ = ('rank', 'price', 'size', 'priority', 'left', 'right', 'total_size', 'total_notional')
+    
+    def __init__(self, rank, price, size, priority):
+        self.rank = rank
+        self.price = price
+        self.size = size
+        self.priority = priority
+        self.left = None
+        self.right = None
+        
+        # Sums over the subtree rooted at this level
+        self.total_size = size
+        self.total_notional = size * price
+
+
+class DepthIndex:
+    """Cumulative depth of a single side of the orderbook, aggregated by price level.
+    Price levels are kept in a treap (randomized balanced binary search tree) sorted from best to worst,
+    where every node also holds the total size and notional (size * price) of its subtree.
+    Updating a level, adding a new level, dropping an emptied level and all queries are O(log(L)) expected,
+    L being the number of non-empty price levels.
+    The best level is the highest price if best='max' (bids), or the lowest if best='min' (asks).
+    """
+    
+    def __init__(self, best):
+        if best != 'max' and best != 'min':
+            raise ValueError(f'Tried to initialize DepthIndex with illegal best arg: "{best}". Only "max" or "min" allowed.')
+        self.best = best
+        
+        # Price levels are stored by rank: -price for best='max', price for best='min', so rank order is best first.
+        self.root = None
+        self.levels = {}  # rank: _Level
+        self._random = random.Random()
+    
+    def _rank(self, price):
+        return -price if self.best == 'max' else price
+    
+    # O(log(L))
+    def add(self, price, size):
+        """Adds size (negative to subtract) to the price level. A level is dropped once it holds no size."""
+        if not size:
+            return
+        rank = self._rank(price)
+        level = self.levels.get(rank)
+        if level is None:
+            if size > 0:
+                level = _Level(rank, price, size, self._random.random())
+                self.levels[rank] = level
+                left, right = self._split(self.root, rank)
+                self.root = self._merge(self._merge(left, level), right)
+            return
+        
+        if level.size + size <= 0:
+            del self.levels[rank]
+            self.root = self._remove(self.root, rank)
+            return
+        
+        # Walk down to the level, updating the sums of its ancestors on the way
+        notional = size * price
+        node = self.root
+        while node is not level:
+            node.total_size += size
+            node.total_notional += notional
+            node = node.left if rank < node.rank else node.right
+        level.size += size
+        level.total_size += size
+        level.total_notional += notional
+    
+    @staticmethod
+    def _update(node):
+        node.total_size = node.size
+        node.total_notional = node.size * node.price
+        if node.left:
+            node.total_size += node.left.total_size
+            node.total_notional += node.left.total_notional
+        if node.right:
+            node.total_size += node.right.total_size
+            node.total_notional += node.right.total_notional
+    
+    def _split(self, node, rank):
+        """Splits the subtree into (levels ranked below rank, levels ranked at or above rank)."""
+        if node is None:
+            return None, None
+        if node.rank < rank:
+            left, right = self._split(node.right, rank)
+            node.right = left
+            self._update(node)
+            return node, right
+        left, right = self._split(node.left, rank)
+        node.left = right
+        self._update(node)
+        return left, node
+    
+    def _merge(self, left, right):
+        """Merges two subtrees, all of left's levels ranked below right's."""
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self._merge(left.right, right)
+            self._update(left)
+            return left
+        right.left = self._merge(left, right.left)
+        self._update(right)
+        return right
+    
+    def _remove(self, node, rank):
+        if node.rank == rank:
+            return self._merge(node.left, node.right)
+        if rank < node.rank:
+            node.left = self._remove(node.left, rank)
+        else:
+            node.right = self._remove(node.right, rank)
+        self._update(node)
+        return node
+    
+    # O(1)
+    def total_size(self):
+        return self.root.total_size if self.root else 0
+    
+    # O(log(L))
+    def best_price(self):
+        """Returns the price of the best (leftmost) level, or None if the side is empty."""
+        node = self.root
+        if node is None:
+            return None
+        while node.left:
+            node = node.left
+        return node.price
+    
+    # O(log(L))
+    def available_size(self, limit_price):
+        """Returns the total size resting at limit_price or better."""
+        rank = self._rank(limit_price)
+        size = 0
+        node = self.root
+        while node:
+            if node.rank <= rank:
+                size += node.size + (node.left.total_size if node.left else 0)
+                node = node.right
+            else:
+                node = node.left
+        return size
+    
+    # O(log(L))
+    def fill(self, qty):
+        """Walks the book from the best level until qty units are filled.
+        Returns (worst price reached, total notional paid), or None if there is not enough size resting."""
+        if qty <= 0:
+            raise ValueError(f'Tried to fill an illegal quantity: {qty}. Only positive quantities allowed.')
+        
+        size = notional = 0
+        node = self.root
+        while node:
+            left = node.left
+            if left and size + left.total_size >= qty:
+                node = left
+                continue
+            if left:
+                size += left.total_size
+                notional += left.total_notional
+            if size + node.size >= qty:
+                return node.price, notional + (qty - size) * node.price
+            size += node.size
+            notional += node.size * node.price
+            node = node.right
+        return None
+    
+    def __len__(self):
+        return len(self.levels)
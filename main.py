@@ -1,6 +1,9 @@
 from util import get_now
-from bintrees import AVLTree
+from books import Book, BACKENDS
+from depth import DepthIndex
+from timers import TimerWheel
 import logging
+import threading
 
 # This is to prevent the notifications from spamming the console while testing.
 # If you still want to see the notifications, set "ALLOW_SUBSCRIBERS_NOTIFICATION" to True.
@@ -27,6 +30,12 @@ class Logger:
         else:
             logging.info(f'ASK | {ask}')
     
+    def log_expired(self, orders, now):
+        """Logs a batch of expired orders as a single event."""
+        lines = [f'EXPIRED | timestamp: {now}, count: {len(orders)}']
+        lines += [f'\t--> {order}' for order in orders]
+        logging.info('\n'.join(lines))
+    
     def log_trade(self, trade):
         logging.info(f'TRADE | {trade}')
         if trade.ask.is_exhausted():
@@ -59,7 +68,7 @@ class Order:
     def __eq__(self, other):
         return self._key() == other._key()
     
-    def __init__(self, side, price, size):
+    def __init__(self, side, price, size, expire_at=None):
         self.timestamp = get_now()  # since epoch
         if side != self.BID and side != self.ASK:
             msg = '\n'.join([f'Tried to initialize Order instance with illegal order side arg: "{side}".',
@@ -71,6 +80,9 @@ class Order:
         self.price = price
         self.id = id(self)
         self.sender_id = ''
+        
+        # Good-till-time: seconds since epoch after which the order is removed by OrderBook.tick(). None == good-till-cancel
+        self.expire_at = expire_at
     
     @property
     def size(self):
@@ -216,11 +228,125 @@ class Subscriber:
         return msg
 
 
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate  # tokens refilled per second
+        self.burst = burst  # bucket capacity
+        self.tokens = burst
+        self.last_refill = now
+    
+    def try_consume(self, now):
+        """Refills the bucket according to the time passed since the last call, then tries to take a single token.
+        Returns True if a token was taken, False if the bucket is empty."""
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Throttle:
+    """Admission control for OrderBook entry points.
+    Each sender has its own token bucket for new orders (default rate / burst, overridable per sender via set_limit()).
+    Cancels never take tokens, so a sender that drained its bucket can still pull its resting orders.
+    OrderBook serializes add_order() / remove_order() behind a lock, so "in flight" means executing or queued on that lock.
+    The book is overloaded once max_in_flight requests are in flight, and new orders are shed before cancels:
+    the last cancel_reserve in-flight slots are kept for remove_order() calls only.
+    A None limit means "unlimited". burst defaults to max(1, rate), and must be at least 1."""
+    
+    def __init__(self, rate=None, burst=None, max_in_flight=None, cancel_reserve=0, clock=get_now):
+        self.rate = rate
+        self.burst = self._validate_burst(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.cancel_reserve = self._validate_cancel_reserve(max_in_flight, cancel_reserve)
+        self.clock = clock
+        
+        self.in_flight = 0
+        self.limits = {}  # sender_id: (rate, burst)
+        self.buckets = {}  # sender_id: TokenBucket
+        
+        # Reject counters, by sender_id. self.shed counts rejects caused by the global in-flight limit.
+        self.rejects = {}
+        self.shed = 0
+        self._lock = threading.Lock()
+    
+    def set_limit(self, sender_id, rate, burst=None):
+        """Overrides the default rate / burst for a single sender. rate=None removes the sender's limit."""
+        self.limits[sender_id] = (rate, self._validate_burst(rate, burst))
+        self.buckets.pop(sender_id, None)
+    
+    @staticmethod
+    def _validate_burst(rate, burst):
+        """Returns the bucket capacity for rate. A bucket that cannot hold a whole token would reject every request."""
+        if rate is None:
+            return None
+        if burst is None:
+            return max(1, rate)
+        if burst < 1:
+            raise ValueError(f'Tried to initialize Throttle with illegal burst arg: {burst}. Only burst >= 1 allowed.')
+        return burst
+    
+    @staticmethod
+    def _validate_cancel_reserve(max_in_flight, cancel_reserve):
+        """Returns cancel_reserve if it leaves at least one in-flight slot to new orders and doesn't give them cancel slots."""
+        if max_in_flight is not None and not 0 <= cancel_reserve < max_in_flight:
+            msg = f'Tried to initialize Throttle with illegal cancel_reserve arg: {cancel_reserve}. ' \
+                  f'Only 0 <= cancel_reserve < max_in_flight ({max_in_flight}) allowed.'
+            raise ValueError(msg)
+        return cancel_reserve
+    
+    # O(1)
+    def admit(self, sender_id, cancel=False):
+        """Returns True and takes an in-flight slot if the request may proceed, otherwise counts the reject and returns False.
+        Every admitted request must be followed by a call to self.release()."""
+        with self._lock:
+            if self.max_in_flight is not None:
+                limit = self.max_in_flight if cancel else self.max_in_flight - self.cancel_reserve
+                if self.in_flight >= limit:
+                    self.shed += 1
+                    self.rejects[sender_id] = self.rejects.get(sender_id, 0) + 1
+                    return False
+            
+            if cancel:
+                self.in_flight += 1
+                return True
+            
+            bucket = self.buckets.get(sender_id)
+            if bucket is None:
+                rate, burst = self.limits.get(sender_id, (self.rate, self.burst))
+                if rate is not None:
+                    bucket = TokenBucket(rate, burst, self.clock())
+                    self.buckets[sender_id] = bucket
+            if bucket is not None and not bucket.try_consume(self.clock()):
+                self.rejects[sender_id] = self.rejects.get(sender_id, 0) + 1
+                return False
+            
+            self.in_flight += 1
+            return True
+    
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
 class OrderBook:
     
-    def __init__(self, logfile_full_path='logs/orderbook.log'):
-        self.bids = AVLTree()
-        self.asks = AVLTree()
+    def __init__(self, logfile_full_path='logs/orderbook.log', throttle: Throttle = None, backend='avl',
+                 expiry_resolution=1.0, track_depth=False):
+        # backend is either a name in books.BACKENDS ('avl', 'heap', 'sorted') or a books.Book subclass.
+        # See benchmark.py for which backend performs best for which flow.
+        book_cls = BACKENDS[backend] if isinstance(backend, str) else backend
+        self.bids: Book = book_cls(best='max')
+        self.asks: Book = book_cls(best='min')
+        
+        # Resting size per price level, for O(log(n)) depth queries (self.available_size(), self.price_to_fill() etc).
+        # Opt-in, so plain order flow doesn't pay for maintaining it
+        self.track_depth = track_depth
+        self.bid_depth = DepthIndex(best='max') if track_depth else None
+        self.ask_depth = DepthIndex(best='min') if track_depth else None
         
         # This is to retrieve an order *by order_id* from the trees in O(log(n)). (self.remove_order())
         # self.bids and self.asks are indexed by Order._key(), which is (self.price, self.size).
@@ -228,12 +354,22 @@ class OrderBook:
         self.trades = {}
         self.subscribers = {}
         self.logger = Logger(logfile_full_path)
+        
+        # Optional admission control, checked before any logging or tree work (see Throttle)
+        self.throttle = throttle
+        
+        # Serializes add_order(), remove_order(), tick() and the depth queries.
+        # Order requests waiting on it count as in flight for self.throttle
+        self.lock = threading.Lock()
+        
+        # Pending expiries of resting orders with an expire_at, by order id. Driven by self.tick()
+        self.expiry = TimerWheel(resolution=expiry_resolution, start=get_now())
     
     # O(log(n))
     def show_top(self):
         """Returns the highest bid and lowest ask orders."""
-        _, highest_bid = self.bids.max_item()
-        _, lowest_ask = self.asks.min_item()
+        _, highest_bid = self.bids.best_item()
+        _, lowest_ask = self.asks.best_item()
         return highest_bid, lowest_ask
     
     # O(n)
@@ -278,7 +414,27 @@ class OrderBook:
         Logs the trade to log file and notifies all its subscriptors via email.
         If a bid, ask, or both are exhausted during the process (i.e. ran out of "size"),
         they are deleted from their respective trees.
+        Returns False without touching the book if the order was rejected by self.throttle,
+        or if its expire_at has already been reached, otherwise True.
         """
+        if order.expire_at is not None and order.expire_at <= get_now():
+            return False
+        
+        if self.throttle is None:
+            with self.lock:
+                self._add_order(order, sender_id)
+            return True
+        
+        if not self.throttle.admit(sender_id):
+            return False
+        try:
+            with self.lock:
+                self._add_order(order, sender_id)
+        finally:
+            self.throttle.release()
+        return True
+    
+    def _add_order(self, order: Order, sender_id):
         order.sender_id = sender_id
         
         # used in remove_order to keep O(log(n)) when retrieving order by order_id
@@ -298,13 +454,17 @@ class OrderBook:
         
         else:
             self._add_ask(order)
+        
+        if order.expire_at is not None and not order.is_exhausted():
+            # order is resting in the book
+            self.expiry.schedule(order.id, order.expire_at, order)
     
     # O(log(n))
     def _add_ask(self, ask: Order):
         self.logger.log_ask(ask)
         
         ask_key = ask._key()
-        self.asks.insert(ask_key, ask)
+        self._insert(self.asks, self.ask_depth, ask_key, ask)
         
         should_continue = True
         while should_continue:
@@ -326,7 +486,7 @@ class OrderBook:
     def _add_bid(self, bid: Order):
         self.logger.log_bid(bid)
         bid_key = bid._key()
-        self.bids.insert(bid_key, bid)
+        self._insert(self.bids, self.bid_depth, bid_key, bid)
         should_continue = True
         while should_continue:
             # Keep trying to finalize trades with current order (bid)
@@ -348,13 +508,33 @@ class OrderBook:
         """
         Removes an order from its respective tree.
         Records the removal in the log.
+        Returns False without touching the book if the cancel was rejected by self.throttle, otherwise True.
+        Under overload, cancels are preferred over new orders (see Throttle.cancel_reserve).
         """
+        if self.throttle is None:
+            with self.lock:
+                self._remove_order(order_id, sender_id)
+            return True
+        
+        if not self.throttle.admit(sender_id, cancel=True):
+            return False
+        try:
+            with self.lock:
+                self._remove_order(order_id, sender_id)
+        finally:
+            self.throttle.release()
+        return True
+    
+    def _remove_order(self, order_id, sender_id):
         order_key = self.order_id_key_translate[order_id]
         bid_to_remove = self.bids.get(order_key)
         if bid_to_remove:
             if bid_to_remove.sender_id == sender_id:
                 self.logger.log_bid(bid_to_remove, removed=True)
                 self.bids.remove(order_key)
+                if self.track_depth:
+                    self.bid_depth.add(bid_to_remove.price, -bid_to_remove.size)
+                self.expiry.cancel(bid_to_remove.id)
         
         else:  # order is not a bid
             ask_to_remove = self.asks.get(order_key)
@@ -366,6 +546,22 @@ class OrderBook:
             if ask_to_remove.sender_id == sender_id:
                 self.logger.log_ask(ask_to_remove, removed=True)
                 self.asks.remove(order_key)
+                if self.track_depth:
+                    self.ask_depth.add(ask_to_remove.price, -ask_to_remove.size)
+                self.expiry.cancel(ask_to_remove.id)
+    
+    # O(log(n))
+    def _insert(self, book: Book, depth: DepthIndex or None, key, order: Order):
+        """Inserts order to book and its size to depth (if depth is tracked).
+        An order already indexed by the same key is replaced, so its size is taken off depth and its expiry is cancelled."""
+        replaced = book.get(key)
+        if replaced is not None and not replaced.is_exhausted():
+            if depth is not None:
+                depth.add(replaced.price, -replaced.size)
+            self.expiry.cancel(replaced.id)
+        book.insert(key, order)
+        if depth is not None:
+            depth.add(order.price, order.size)
     
     # O(log(n))
     def _try_buy(self, bid: Order) -> Trade or None:
@@ -375,14 +571,16 @@ class OrderBook:
         If a trade was finalized, logs the trade to the log and notifies all of its subscribers.
         If a trade was not finalized, returns None.
         """
-        if self.asks.is_empty():
+        lowest_ask = self._best_live_order(self.asks, self.ask_depth)
+        if lowest_ask is None:
             return None
         
-        ask_key, lowest_ask = self.asks.min_item()
-        
         trade = None
         if lowest_ask <= bid:  # someone offered a low-enough sell price and a trade will be made
             trade = Trade(bid, lowest_ask)
+            if self.track_depth:
+                self.bid_depth.add(bid.price, -trade.size)
+                self.ask_depth.add(lowest_ask.price, -trade.size)
             
             # log trade
             self.logger.log_trade(trade)
@@ -394,7 +592,8 @@ class OrderBook:
             self.notify_trade(trade, trade_subscribers)
             
             if lowest_ask.is_exhausted():
-                self.asks.remove(ask_key)
+                self.asks.pop_best()
+                self.expiry.cancel(lowest_ask.id)
         
         return trade
     
@@ -406,13 +605,15 @@ class OrderBook:
         If a trade was finalized, logs the trade to the log and notifies all of its subscribers.
         If a trade was not finalized, returns None.
         """
-        if self.bids.is_empty():
+        highest_bid = self._best_live_order(self.bids, self.bid_depth)
+        if highest_bid is None:
             return None
-        
-        bid_key, highest_bid = self.bids.max_item()
         trade = None
         if highest_bid >= ask:  # someone bid high enough and a trade will be made
             trade = Trade(highest_bid, ask)
+            if self.track_depth:
+                self.bid_depth.add(highest_bid.price, -trade.size)
+                self.ask_depth.add(ask.price, -trade.size)
             self.logger.log_trade(trade)
             
             # get all who subscribed to either side
@@ -422,10 +623,107 @@ class OrderBook:
             self.notify_trade(trade, trade_subscribers)
             
             if highest_bid.is_exhausted():
-                self.bids.remove(bid_key)
+                self.bids.pop_best()
+                self.expiry.cancel(highest_bid.id)
         
         return trade
     
+    # O(k) for k expired orders
+    def tick(self, now=None):
+        """Removes all resting orders whose expire_at has been reached by now (defaults to the current time)
+        from their respective trees, and records them in the log as a single event.
+        Returns the list of expired orders."""
+        if now is None:
+            now = get_now()
+        with self.lock:
+            return self._tick(now)
+    
+    def _tick(self, now):
+        expired = []
+        for order in self.expiry.advance(now):
+            order_key = self.order_id_key_translate[order.id]
+            if order.side == Order.BID:
+                book, depth = self.bids, self.bid_depth
+            else:
+                book, depth = self.asks, self.ask_depth
+            if book.get(order_key) is order:
+                book.remove(order_key)
+                if depth is not None:
+                    depth.add(order.price, -order.size)
+                expired.append(order)
+        
+        if expired:
+            self.logger.log_expired(expired, now)
+        return expired
+    
+    def _depth_against(self, side):
+        """Returns the DepthIndex an order of the passed side would trade against."""
+        if not self.track_depth:
+            raise ValueError('Tried to query depth of an OrderBook that does not track it. Use OrderBook(track_depth=True).')
+        if side == Order.BID:
+            return self.ask_depth
+        if side == Order.ASK:
+            return self.bid_depth
+        msg = '\n'.join([f'Tried to query depth with illegal order side arg: "{side}".',
+                         f'Only "{Order.BID}" or "{Order.ASK}" allowed.'])
+        raise ValueError(msg)
+    
+    # O(log(n))
+    def available_size(self, side, limit_price):
+        """Returns how many units an order of the passed side could trade right now at limit_price or better,
+        i.e. the asks size at or below limit_price for a bid, or the bids size at or above limit_price for an ask.
+        An order of size <= available_size(side, price) would be filled in full (fill-or-kill pre-check)."""
+        with self.lock:
+            return self._depth_against(side).available_size(limit_price)
+    
+    # O(log(n))
+    def price_to_fill(self, side, qty):
+        """Returns the worst price an order of the passed side would reach to fill qty units,
+        i.e. the lowest limit price that fills it in full. Returns None if the book cannot fill qty units."""
+        with self.lock:
+            fill = self._depth_against(side).fill(qty)
+        return fill[0] if fill else None
+    
+    # O(log(n))
+    def average_fill_price(self, side, qty):
+        """Returns the average price per unit an order of the passed side would pay (or get) to fill qty units.
+        Returns None if the book cannot fill qty units."""
+        with self.lock:
+            fill = self._depth_against(side).fill(qty)
+        return fill[1] / qty if fill else None
+    
+    # O(log(n))
+    def impact_cost(self, side, qty):
+        """Returns how much worse per unit than the top of the book the average fill price of qty units is:
+        the average price paid above the lowest ask for a bid, or the average price got below the highest bid for an ask.
+        Returns None if the book cannot fill qty units."""
+        with self.lock:
+            depth = self._depth_against(side)
+            fill = depth.fill(qty)
+            if not fill:
+                return None
+            best_price = depth.best_price()
+        average_price = fill[1] / qty
+        if side == Order.BID:
+            return average_price - best_price
+        return best_price - average_price
+    
+    # O(log(n)) per expired order
+    def _best_live_order(self, book: Book, depth: DepthIndex or None):
+        """Returns the best order in book, or None if book is empty.
+        Best orders whose expire_at has been reached are expired on the way (removed and logged) instead of being traded,
+        so they never match even if self.tick() hasn't run yet."""
+        while not book.is_empty():
+            _, best_order = book.best_item()
+            if best_order.expire_at is None or best_order.expire_at > get_now():
+                return best_order
+            book.pop_best()
+            if depth is not None:
+                depth.add(best_order.price, -best_order.size)
+            self.expiry.cancel(best_order.id)
+            self.logger.log_expired([best_order], get_now())
+        return None
+    
     def _subscribers_of_orders(self, *orders):
         """Returns a list of Subscribers that have subscribed to any of the passed orders"""
         return [sub for sub in self.subscribers.values()
@@ -1,7 +1,9 @@
 import unittest
 
-from main import OrderBook, Order
-from util import random_str
+from main import OrderBook, Order, Throttle
+from books import Book, BACKENDS
+from timers import TimerWheel
+from util import random_str, get_now
 import logging
 import os
 import re
@@ -277,6 +279,388 @@ class TestOrderBook(unittest.TestCase):
                              ))
             for i, line in enumerate(lines):
                 self.assertRegex(line, regex[i])
+    
+    def test_throttle_sender_rate(self):
+        now = [1000.0]
+        throttle = Throttle(rate=2, burst=2, clock=lambda: now[0])
+        throttle.set_limit('vip', rate=5)
+        order_book = OrderBook(f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log', throttle=throttle)
+        
+        self.assertTrue(order_book.add_order(self.create_bid(10, 1), 'flooder'))
+        self.assertTrue(order_book.add_order(self.create_bid(11, 1), 'flooder'))
+        self.assertFalse(order_book.add_order(self.create_bid(12, 1), 'flooder'))
+        for i in range(5):
+            self.assertTrue(order_book.add_order(self.create_bid(20 + i, 1), 'vip'))
+        self.assertFalse(order_book.add_order(self.create_bid(30, 1), 'vip'))
+        
+        # Rejected orders never reach the book
+        self.assertEqual(order_book.bids.count, 7)
+        self.assertEqual(throttle.rejects, {'flooder': 1, 'vip': 1})
+        self.assertEqual(throttle.shed, 0)
+        
+        # Half a second later, 'flooder' has refilled a single token
+        now[0] += 0.5
+        self.assertTrue(order_book.add_order(self.create_bid(13, 1), 'flooder'))
+        self.assertFalse(order_book.add_order(self.create_bid(14, 1), 'flooder'))
+        self.assertEqual(throttle.in_flight, 0)
+    
+    def test_throttle_sheds_orders_before_cancels(self):
+        import threading
+        import time
+        throttle = Throttle(max_in_flight=2, cancel_reserve=1)
+        order_book = OrderBook(f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log', throttle=throttle)
+        bid = self.create_bid(10, 1)
+        queued_bid = self.create_bid(11, 1)
+        self.assertTrue(order_book.add_order(bid, 'sender'))
+        
+        results = {}
+        
+        def run_in_thread(name, method, *args):
+            thread = threading.Thread(target=lambda: results.setdefault(name, method(*args)))
+            thread.start()
+            return thread
+        
+        def wait_for_in_flight(n):
+            deadline = time.time() + 5
+            while throttle.in_flight != n:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.001)
+        
+        # Keep the engine busy, so admitted requests queue up on its lock
+        order_book.lock.acquire()
+        try:
+            threads = [run_in_thread('add', order_book.add_order, queued_bid, 'queued')]
+            wait_for_in_flight(1)
+            # Overloaded for new orders, but the reserved slot is still free for a cancel
+            self.assertFalse(order_book.add_order(self.create_bid(12, 1), 'sender'))
+            threads.append(run_in_thread('remove', order_book.remove_order, bid.id, 'sender'))
+            wait_for_in_flight(2)
+            self.assertFalse(order_book.remove_order(bid.id, 'sender'))
+        finally:
+            order_book.lock.release()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(results, {'add': True, 'remove': True})
+        self.assertEqual(list(order_book.bids.values()), [queued_bid])
+        self.assertEqual(throttle.shed, 2)
+        self.assertEqual(throttle.rejects, {'sender': 2})
+        self.assertEqual(throttle.in_flight, 0)
+    
+    def test_throttle_cancels_skip_sender_bucket(self):
+        now = [1000.0]
+        throttle = Throttle(rate=1, burst=1, max_in_flight=10, cancel_reserve=5, clock=lambda: now[0])
+        order_book = OrderBook(f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log', throttle=throttle)
+        bid = self.create_bid(10, 1)
+        self.assertTrue(order_book.add_order(bid, 'sender'))
+        self.assertFalse(order_book.add_order(self.create_bid(11, 1), 'sender'))
+        self.assertTrue(order_book.remove_order(bid.id, 'sender'))
+        self.assertTrue(order_book.bids.is_empty())
+    
+    def test_throttle_burst(self):
+        now = [1000.0]
+        throttle = Throttle(rate=0.5, clock=lambda: now[0])
+        self.assertEqual(throttle.burst, 1)
+        self.assertTrue(throttle.admit('sender'))
+        throttle.release()
+        self.assertFalse(throttle.admit('sender'))
+        now[0] += 2
+        self.assertTrue(throttle.admit('sender'))
+        throttle.release()
+        
+        with self.assertRaises(ValueError):
+            Throttle(rate=0.5, burst=0.5)
+        with self.assertRaises(ValueError):
+            throttle.set_limit('vip', rate=5, burst=0)
+    
+    def test_throttle_cancel_reserve(self):
+        self.assertEqual(Throttle(max_in_flight=2, cancel_reserve=1).cancel_reserve, 1)
+        self.assertEqual(Throttle(cancel_reserve=0).cancel_reserve, 0)
+        for cancel_reserve in (2, 3, -1):
+            with self.assertRaises(ValueError):
+                Throttle(max_in_flight=2, cancel_reserve=cancel_reserve)
+    
+    def test_backends_agree(self):
+        log_file = f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log'
+        states = {}
+        for backend in BACKENDS:
+            order_book = OrderBook(log_file, backend=backend)
+            for price, size in ((100, 10), (70, 15), (99, 7), (101, 9)):
+                order_book.add_order(self.create_bid(price, size), random_str())
+            for price, size in ((120, 3), (130, 4), (110, 5)):
+                order_book.add_order(self.create_ask(price, size), random_str())
+            order_book.add_order(self.create_ask(99, 12), random_str())
+            order_book.add_order(self.create_bid(125, 6), random_str())
+            to_remove = self.create_ask(140, 1)
+            order_book.add_order(to_remove, 'sender')
+            order_book.remove_order(to_remove.id, 'sender')
+            
+            highest_bid, lowest_ask = order_book.show_top()
+            states[backend] = (
+                [(bid.price, bid.size) for bid in order_book.bids.values()],
+                [(ask.price, ask.size) for ask in order_book.asks.values()],
+                [(trade.price, trade.size) for trade in order_book.show_trades()],
+                (highest_bid.price, highest_bid.size),
+                (lowest_ask.price, lowest_ask.size),
+                )
+        
+        expected = states['avl']
+        self.assertEqual(expected[0], [(70, 15), (99, 7), (100, 7)])
+        self.assertEqual(expected[1], [(120, 2), (130, 4)])
+        for backend, state in states.items():
+            self.assertEqual(state, expected, backend)
+    
+    def test_backend_pop_best_and_remove(self):
+        for name, book_cls in BACKENDS.items():
+            bids = book_cls(best='max')
+            asks = book_cls(best='min')
+            for key in ((5, 1), (3, 1), (9, 2), (7, 1)):
+                bids.insert(key, key)
+                asks.insert(key, key)
+            bids.remove((9, 2))
+            asks.remove((3, 1))
+            
+            self.assertEqual(bids.best_item(), ((7, 1), (7, 1)), name)
+            self.assertEqual(asks.best_item(), ((5, 1), (5, 1)), name)
+            self.assertEqual(bids.pop_best(), ((7, 1), (7, 1)), name)
+            self.assertEqual(asks.pop_best(), ((5, 1), (5, 1)), name)
+            self.assertEqual(list(bids.keys()), [(3, 1), (5, 1)], name)
+            self.assertEqual(list(asks.keys()), [(7, 1), (9, 2)], name)
+            self.assertEqual(bids.count, 2, name)
+            self.assertIsNone(bids.get((9, 2)), name)
+            with self.assertRaises(KeyError):
+                bids.remove((9, 2))
+            
+            bids.pop_best()
+            bids.pop_best()
+            self.assertTrue(bids.is_empty(), name)
+            with self.assertRaises(ValueError):
+                bids.best_item()
+        
+        class IncompleteBook(Book):
+            def insert(self, key, order):
+                pass
+        
+        # A backend missing part of the interface fails when constructed, not while matching
+        with self.assertRaises(TypeError):
+            OrderBook(f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log', backend=IncompleteBook)
+    
+    def test_depth_queries(self):
+        log_file = f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log'
+        with self.assertRaises(ValueError):
+            OrderBook(log_file).available_size(Order.BID, 100)
+        
+        order_book = OrderBook(log_file, track_depth=True)
+        for price, size in ((100, 10), (70, 15), (99, 7), (101, 9)):
+            order_book.add_order(self.create_bid(price, size), random_str())
+        order_book.add_order(self.create_ask(105, 5), random_str())
+        order_book.add_order(self.create_ask(110, 10), random_str())
+        order_book.add_order(self.create_ask(105, 3), random_str())
+        
+        # Buying against asks: 8 @ 105, 10 @ 110
+        self.assertEqual(order_book.available_size(Order.BID, 104), 0)
+        self.assertEqual(order_book.available_size(Order.BID, 105), 8)
+        self.assertEqual(order_book.available_size(Order.BID, 200), 18)
+        self.assertEqual(order_book.price_to_fill(Order.BID, 8), 105)
+        self.assertEqual(order_book.price_to_fill(Order.BID, 9), 110)
+        self.assertEqual(order_book.average_fill_price(Order.BID, 10), (8 * 105 + 2 * 110) / 10)
+        self.assertEqual(order_book.impact_cost(Order.BID, 10), (8 * 105 + 2 * 110) / 10 - 105)
+        self.assertIsNone(order_book.price_to_fill(Order.BID, 19))
+        
+        # Selling against bids: 9 @ 101, 10 @ 100, 7 @ 99, 15 @ 70
+        self.assertEqual(order_book.available_size(Order.ASK, 100), 19)
+        self.assertEqual(order_book.price_to_fill(Order.ASK, 20), 99)
+        self.assertEqual(order_book.impact_cost(Order.ASK, 9), 0)
+        
+        # Trades and removals are reflected
+        order_book.add_order(self.create_ask(100, 12), random_str())
+        self.assertEqual(order_book.available_size(Order.ASK, 100), 7)
+        bid_99 = next(bid for bid in order_book.bids.values() if bid.price == 99)
+        order_book.remove_order(bid_99.id, bid_99.sender_id)
+        self.assertEqual(order_book.available_size(Order.ASK, 70), 22)
+        self.assertEqual(order_book.price_to_fill(Order.ASK, 8), 70)
+        
+        with self.assertRaises(ValueError):
+            order_book.available_size('not a nor b', 100)
+    
+    def test_depth_fractional_sizes(self):
+        order_book = OrderBook(f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log', track_depth=True)
+        order_book.add_order(self.create_ask(100, 0.5), random_str())
+        order_book.add_order(self.create_ask(101, 0.25), random_str())
+        self.assertEqual(order_book.impact_cost(Order.BID, 0.5), 0)
+        self.assertEqual(order_book.impact_cost(Order.BID, 0.75), (0.5 * 100 + 0.25 * 101) / 0.75 - 100)
+        
+        order_book.add_order(self.create_ask(101, 2), random_str())
+        self.assertEqual(order_book.ask_depth.best_price(), 100)
+        self.assertEqual(order_book.impact_cost(Order.BID, 2), 0.75)
+        
+        order_book.add_order(self.create_bid(90, 0.5), random_str())
+        order_book.add_order(self.create_bid(89, 2), random_str())
+        self.assertEqual(order_book.impact_cost(Order.ASK, 2), 0.75)
+    
+    def test_depth_queries_wait_for_book(self):
+        import threading
+        order_book = OrderBook(f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log', track_depth=True)
+        order_book.add_order(self.create_ask(100, 5), random_str())
+        results = []
+        
+        order_book.lock.acquire()
+        try:
+            thread = threading.Thread(target=lambda: results.append(order_book.available_size(Order.BID, 100)))
+            thread.start()
+            thread.join(0.05)
+            # The query can't read the depth index while the book is being updated
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(results, [])
+        finally:
+            order_book.lock.release()
+        thread.join()
+        self.assertEqual(results, [5])
+    
+    def test_depth_matches_book(self):
+        import random
+        rng = random.Random(0)
+        log_file = f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log'
+        for backend in BACKENDS:
+            order_book = OrderBook(log_file, backend=backend, track_depth=True)
+            resting = []
+            for _ in range(300):
+                if resting and rng.random() < 0.3:
+                    order = resting.pop(rng.randrange(len(resting)))
+                    try:
+                        order_book.remove_order(order.id, order.sender_id)
+                    except KeyError:
+                        pass
+                else:
+                    side = Order.BID if rng.random() < 0.5 else Order.ASK
+                    order = Order(side, rng.randint(90, 110), rng.randint(1, 20))
+                    order_book.add_order(order, random_str())
+                    resting.append(order)
+            
+            for limit in range(85, 116):
+                asks_size = sum(ask.size for ask in order_book.asks.values() if ask.price <= limit)
+                bids_size = sum(bid.size for bid in order_book.bids.values() if bid.price >= limit)
+                self.assertEqual(order_book.available_size(Order.BID, limit), asks_size, backend)
+                self.assertEqual(order_book.available_size(Order.ASK, limit), bids_size, backend)
+            
+            asks = list(order_book.asks.values())
+            for qty in range(1, sum(ask.size for ask in asks) + 1):
+                # The qty-th unit bought is at the price of the first ask whose cumulative size reaches qty
+                cumulative = 0
+                for ask in asks:
+                    cumulative += ask.size
+                    if cumulative >= qty:
+                        break
+                self.assertEqual(order_book.price_to_fill(Order.BID, qty), ask.price, backend)
+            
+            # Only non-empty price levels are kept
+            self.assertEqual(len(order_book.ask_depth), len({ask.price for ask in asks}), backend)
+            for order in list(order_book.bids.values()) + asks:
+                order_book.remove_order(order.id, order.sender_id)
+            self.assertEqual(len(order_book.bid_depth), 0, backend)
+            self.assertEqual(len(order_book.ask_depth), 0, backend)
+            self.assertIsNone(order_book.price_to_fill(Order.BID, 1), backend)
+    
+    def test_expired_orders_never_trade(self):
+        import time
+        new_log_file = f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log'
+        order_book = OrderBook(new_log_file, track_depth=True)
+        
+        # Already expired on entry
+        self.assertFalse(order_book.add_order(Order(Order.ASK, 100, 5, expire_at=get_now() - 100), random_str()))
+        self.assertTrue(order_book.asks.is_empty())
+        
+        # Expires while resting, before any tick()
+        stale_ask = Order(Order.ASK, 100, 5, expire_at=get_now() + 0.05)
+        live_ask = Order(Order.ASK, 101, 5)
+        self.assertTrue(order_book.add_order(stale_ask, random_str()))
+        self.assertTrue(order_book.add_order(live_ask, random_str()))
+        time.sleep(0.1)
+        
+        order_book.add_order(self.create_bid(102, 2), random_str())
+        trades = order_book.show_trades()
+        self.assertEqual(len(trades), 1)
+        self.assertIs(trades[0].ask, live_ask)
+        self.assertEqual(list(order_book.asks.values()), [live_ask])
+        self.assertEqual(order_book.available_size(Order.BID, 101), 3)
+        self.assertEqual(len(order_book.expiry), 0)
+        self.assertEqual(order_book.tick(), [])
+        
+        with open(new_log_file, 'r') as f:
+            log = f.read()
+        self.assertRegex(log, r'EXPIRED \| timestamp: \d+\.\d+, count: 1\n\t--> timestamp: \d+\.\d+, side: a, price: 100, size: 5')
+    
+    def test_timer_wheel(self):
+        import random
+        rng = random.Random(0)
+        wheel = TimerWheel(resolution=1.0, start=0.0, slot_bits=2, levels=3)  # covers 64 ticks
+        timers = {key: rng.uniform(0, 200) for key in range(500)}
+        for key, when in timers.items():
+            wheel.schedule(key, when, key)
+        cancelled = set(rng.sample(list(timers), 100))
+        for key in cancelled:
+            self.assertTrue(wheel.cancel(key))
+        self.assertFalse(wheel.cancel(next(iter(cancelled))))
+        
+        fired = {}
+        for now in range(0, 210, 3):
+            for key in wheel.advance(now):
+                self.assertNotIn(key, fired)
+                fired[key] = now
+        
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(set(fired), set(timers) - cancelled)
+        for key, now in fired.items():
+            # Never early, and at the first advance() after the timer's tick
+            self.assertLessEqual(timers[key], now)
+            self.assertGreater(timers[key], now - 4)
+        
+        with self.assertRaises(ValueError):
+            TimerWheel(slot_bits=1, levels=1)
+    
+    def test_timer_wheel_skips_idle_ticks(self):
+        wheel = TimerWheel(resolution=1.0, start=0.0)
+        year = 365 * 24 * 3600
+        wheel.schedule('gtt', year, 'gtt')
+        
+        # A day passes with nothing due: only cascade points of occupied slots are visited, not 86400 ticks
+        self.assertEqual(wheel.advance(86400), [])
+        self.assertLessEqual(wheel.visited_ticks, 4)
+        self.assertEqual(wheel.advance(year - 1), [])
+        self.assertEqual(wheel.advance(year), ['gtt'])
+        self.assertLessEqual(wheel.visited_ticks, 4 * wheel.levels)
+    
+    def test_tick_expires_orders(self):
+        new_log_file = f'{TESTS_FOLDER_NAME}/{self._testMethodName}.log'
+        order_book = OrderBook(new_log_file, backend='heap', track_depth=True)
+        now = int(get_now())
+        gtc_bid = self.create_bid(90, 5)
+        bid = Order(Order.BID, 100, 5, expire_at=now + 10)
+        filled_bid = Order(Order.BID, 95, 3, expire_at=now + 10)
+        removed_ask = Order(Order.ASK, 120, 4, expire_at=now + 10)
+        late_ask = Order(Order.ASK, 130, 4, expire_at=now + 5000)
+        for order in (gtc_bid, bid, filled_bid, removed_ask, late_ask):
+            order_book.add_order(order, random_str())
+        order_book.add_order(self.create_ask(95, 8), random_str())  # fills bid and filled_bid
+        order_book.remove_order(removed_ask.id, removed_ask.sender_id)
+        self.assertEqual(len(order_book.expiry), 1)
+        
+        partial_bid = Order(Order.BID, 99, 10, expire_at=now + 10)
+        order_book.add_order(partial_bid, random_str())
+        order_book.add_order(self.create_ask(99, 4), random_str())
+        
+        self.assertEqual(order_book.tick(now + 9), [])
+        self.assertEqual(order_book.tick(now + 10), [partial_bid])
+        self.assertEqual([bid.price for bid in order_book.bids.values()], [90])
+        self.assertEqual(order_book.available_size(Order.ASK, 0), 5)
+        self.assertEqual(order_book.tick(now + 5000), [late_ask])
+        self.assertTrue(order_book.asks.is_empty())
+        self.assertEqual(order_book.available_size(Order.BID, 1000), 0)
+        
+        with open(new_log_file, 'r') as f:
+            log = f.read()
+        self.assertEqual(log.count('EXPIRED'), 2)
+        self.assertRegex(log, r'EXPIRED \| timestamp: \d+, count: 1\n\t--> timestamp: \d{10}\.\d+, side: b, price: 99, size: 6')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,123 @@
+import math
+
+
+class TimerWheel:
+    """Hierarchical timer wheel.
+    Time is split into ticks of `resolution` seconds. Each level has 2 ** slot_bits slots. Level 0 has one slot
+    per tick, and each next level's slots are 2 ** slot_bits times wider, so the wheel covers 2 ** (slot_bits * levels)
+    ticks ahead (timers further away are parked in the last level and re-placed when reached).
+    schedule() and cancel() are O(1). advance() only stops at ticks where an occupied slot is reached,
+    so it costs O(1) per timer that expires or moves down a level (times a scan of 2 ** slot_bits slots per level),
+    regardless of how much time has passed or how many timers are pending.
+    Timers never fire early: a timer is due at the first tick boundary at or after its time.
+    """
+    
+    def __init__(self, resolution=1.0, start=0.0, slot_bits=6, levels=4):
+        if levels < 2:
+            # Timers beyond the range of a single level would be parked in a slot that fires them early
+            raise ValueError(f'Tried to initialize TimerWheel with illegal levels arg: {levels}. Only levels >= 2 allowed.')
+        self.resolution = resolution
+        self.slot_bits = slot_bits
+        self.slot_mask = (1 << slot_bits) - 1
+        self.levels = levels
+        self.wheels = [[{} for _ in range(1 << slot_bits)] for _ in range(levels)]
+        self.current_tick = math.floor(start / resolution)
+        
+        self.due = {}  # timers scheduled at or before the current tick, fired by the next advance()
+        self.visited_ticks = 0  # ticks advance() actually stopped at, for monitoring
+        self.slot_of_key = {}  # key: the slot dict holding it, for O(1) cancel()
+    
+    # O(1)
+    def schedule(self, key, when, item=None):
+        """Schedules item to be returned by advance() once `when` (seconds) is reached.
+        Re-scheduling an existing key replaces its timer."""
+        self.cancel(key)
+        self._place(key, math.ceil(when / self.resolution), item)
+    
+    def _place(self, key, expire_tick, item):
+        delta = expire_tick - self.current_tick
+        if delta <= 0:
+            slot = self.due
+        else:
+            level = 0
+            while level < self.levels - 1 and delta >> (self.slot_bits * (level + 1)):
+                level += 1
+            slot_tick = expire_tick
+            if delta >> (self.slot_bits * self.levels):
+                # Beyond the wheel's range. Park in the last slot of the last level to be reached,
+                # it will be re-placed by its real expire_tick once cascaded
+                slot_tick = self.current_tick + (1 << (self.slot_bits * self.levels)) - 1
+            slot = self.wheels[level][(slot_tick >> (self.slot_bits * level)) & self.slot_mask]
+        slot[key] = (expire_tick, item)
+        self.slot_of_key[key] = slot
+    
+    # O(1)
+    def cancel(self, key):
+        """Cancels key's timer. Returns True if it was pending, otherwise False."""
+        slot = self.slot_of_key.pop(key, None)
+        if slot is None:
+            return False
+        del slot[key]
+        return True
+    
+    def advance(self, now):
+        """Moves the wheel forward to `now` (seconds). Returns the items of all timers that are now due.
+        Ticks at which no occupied slot is reached are skipped, not walked one by one."""
+        target_tick = math.floor(now / self.resolution)
+        expired = self._pop_slot(self.due)
+        
+        while self.current_tick < target_tick:
+            tick = self._next_occupied_tick()
+            if tick is None or tick > target_tick:
+                self.current_tick = target_tick
+                break
+            self.current_tick = tick
+            self.visited_ticks += 1
+            
+            # Cascade: whenever a level wraps, its next level's current slot is re-placed into lower levels
+            for level in range(1, self.levels):
+                if tick & ((1 << (self.slot_bits * level)) - 1):
+                    break
+                slot = self.wheels[level][(tick >> (self.slot_bits * level)) & self.slot_mask]
+                for key, (expire_tick, item) in self._pop_slot_entries(slot):
+                    self._place(key, expire_tick, item)
+            
+            expired += self._pop_slot(self.wheels[0][tick & self.slot_mask])
+            expired += self._pop_slot(self.due)
+        return expired
+    
+    def _next_occupied_tick(self):
+        """Returns the first tick after the current one at which an occupied slot (of any level) is reached,
+        or None if no timer is pending. O(levels * 2 ** slot_bits), independent of the number of timers."""
+        next_tick = None
+        for level in range(self.levels):
+            shift = self.slot_bits * level
+            first_tick = ((self.current_tick >> shift) + 1) << shift
+            if next_tick is not None and first_tick >= next_tick:
+                # Higher levels' slots are only reached later than this
+                break
+            wheel = self.wheels[level]
+            for i in range(1 << self.slot_bits):
+                tick = first_tick + (i << shift)
+                if next_tick is not None and tick >= next_tick:
+                    break
+                if wheel[(tick >> shift) & self.slot_mask]:
+                    next_tick = tick
+                    break
+        return next_tick
+    
+    def _pop_slot_entries(self, slot):
+        entries = list(slot.items())
+        slot.clear()
+        for key, _ in entries:
+            del self.slot_of_key[key]
+        return entries
+    
+    def _pop_slot(self, slot):
+        return [item for _, (_, item) in self._pop_slot_entries(slot)]
+    
+    def __len__(self):
+        return len(self.slot_of_key)
+    
+    def __contains__(self, key):
+        return key in self.slot_of_key